@@ -1,37 +1,158 @@
-from erpnext.edi.doctype.code_list.code_list import get_codes_for, get_default_code
+import hashlib
+from collections.abc import Iterable
+
+import frappe
+from erpnext.edi.doctype.code_list.code_list import get_default_code
+
+CACHE_KEY = "eu_einvoice:common_code"
 
 
 class CommonCodeRetriever:
 	"""Retrieve a common code from a list of code lists and a list of records."""
 
 	def __init__(self, code_lists: list[str], default_code: str):
-		self.code_lists = code_lists
+		self.code_lists = tuple(code_lists)
 		self.default_code = default_code
 
-	def get(self, records: list[tuple[str, str]]) -> str | None:
+	def get(self, records: Iterable[tuple[str, str]]) -> str | None:
 		return self.get_code(records) or self.get_default_code() or self.default_code
 
-	def get_code(self, records: list[tuple[str, str]]) -> str | None:
+	def get_code(self, records: Iterable[tuple[str, str]]) -> str | None:
 		"""Find a common code from a given list of records."""
-		codes = None
-		for code_list in self.code_lists:
-			for doctype, name in records:
-				if not name:
-					continue
+		records = tuple((doctype, name) for doctype, name in records if name)
+		if not records:
+			return None
 
-				codes = get_codes_for(code_list, doctype, name)
-				if codes:
-					break
-			if codes:
-				break
-
-		return codes[0] if codes else None
+		return frappe.cache.hget(
+			CACHE_KEY,
+			_get_cache_field("code", self.code_lists, records),
+			generator=lambda: _get_code(self.code_lists, records),
+		)
 
 	def get_default_code(self) -> str | None:
 		"""Find the default common code from the list of code lists."""
-		for code_list in self.code_lists:
-			default_code = get_default_code(code_list)
-			if default_code:
-				return default_code
+		return frappe.cache.hget(
+			CACHE_KEY,
+			_get_cache_field("default", self.code_lists),
+			generator=lambda: _get_default_code(self.code_lists),
+		)
+
+
+def get_codes_for_records(
+	code_lists: list[str], records: list[tuple[str, str]]
+) -> dict[tuple[str, str, str], str]:
+	"""Return the first common code of each record in each code list, fetched in a single query.
+
+	The result is keyed by `(code_list, doctype, name)`. Records without a common
+	code in a code list are missing from the result.
+	"""
+	if not code_lists or not records:
+		return {}
+
+	CommonCode = frappe.qb.DocType("Common Code")
+	DynamicLink = frappe.qb.DocType("Dynamic Link")
+	rows = (
+		frappe.qb.from_(CommonCode)
+		.join(DynamicLink)
+		.on((CommonCode.name == DynamicLink.parent) & (DynamicLink.parenttype == "Common Code"))
+		.select(CommonCode.code_list, DynamicLink.link_doctype, DynamicLink.link_name, CommonCode.common_code)
+		.where(
+			CommonCode.code_list.isin(list(code_lists))
+			& DynamicLink.link_doctype.isin(list({doctype for doctype, _ in records}))
+			& DynamicLink.link_name.isin(list({name for _, name in records}))
+		)
+		.orderby(CommonCode.common_code)
+	).run()
+
+	codes = {}
+	for code_list, link_doctype, link_name, common_code in rows:
+		# rows are sorted by common code, keep the first one per record
+		codes.setdefault((code_list, link_doctype, link_name), common_code)
+
+	return codes
+
+
+def get_docnames_for_codes(code_lists: list[str], doctype: str, codes: Iterable[str]) -> dict[str, str]:
+	"""Map common codes to the first record of `doctype` they apply to, fetched in a single query.
+
+	The database may match codes case-insensitively, so the result is keyed by the
+	casefolded code. Code lists take precedence in the given order. Codes without a
+	record are missing from the result.
+	"""
+	codes = list(set(codes))
+	if not code_lists or not codes:
+		return {}
+
+	CommonCode = frappe.qb.DocType("Common Code")
+	DynamicLink = frappe.qb.DocType("Dynamic Link")
+	rows = (
+		frappe.qb.from_(CommonCode)
+		.join(DynamicLink)
+		.on((CommonCode.name == DynamicLink.parent) & (DynamicLink.parenttype == "Common Code"))
+		.select(CommonCode.code_list, CommonCode.common_code, DynamicLink.link_name)
+		.where(
+			CommonCode.code_list.isin(list(code_lists))
+			& CommonCode.common_code.isin(codes)
+			& (DynamicLink.link_doctype == doctype)
+		)
+		.orderby(DynamicLink.modified, order=frappe.qb.desc)
+	).run()
+
+	return _get_docnames_by_code(code_lists, codes, rows)
+
+
+def _get_docnames_by_code(
+	code_lists: list[str], codes: Iterable[str], rows: Iterable[tuple[str, str, str]]
+) -> dict[str, str]:
+	"""Pick the docname for each code from `(code_list, common_code, link_name)` rows.
+
+	Rows are expected in order of preference. The result is keyed by the casefolded code.
+	"""
+	docnames_by_list = {}
+	for code_list, common_code, link_name in rows:
+		docnames_by_list.setdefault((code_list, common_code.casefold()), link_name)
+
+	docnames = {}
+	for code_list in code_lists:
+		for code in {code.casefold() for code in codes}:
+			if code not in docnames and (code_list, code) in docnames_by_list:
+				docnames[code] = docnames_by_list[(code_list, code)]
+
+	return docnames
+
+
+def clear_cache(doc=None, method=None):
+	"""Drop all cached common code lookups.
+
+	Called via doc_events when a Code List or Common Code changes, and on `bench clear-cache`.
+	"""
+	frappe.cache.delete_key(CACHE_KEY)
+
+
+def _get_cache_field(*args) -> str:
+	return hashlib.md5(repr(args).encode(), usedforsecurity=False).hexdigest()
+
+
+def _get_code(code_lists: tuple[str, ...], records: tuple[tuple[str, str], ...]) -> str | None:
+	"""Return the first common code of the records.
+
+	Code lists take precedence over records, both are checked in the given order.
+	"""
+	codes = get_codes_for_records(code_lists, records)
+	for code_list in code_lists:
+		for doctype, name in records:
+			code = codes.get((code_list, doctype, name))
+			if code:
+				return code
+
+	return None
+
+
+def _get_default_code(code_lists: tuple[str, ...]) -> str | None:
+	"""Return the first default common code of the code lists."""
+	for code_list in code_lists:
+		default_code = get_default_code(code_list)
+		if default_code:
+			return default_code
 
-		return None
+	return None
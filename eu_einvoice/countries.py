@@ -0,0 +1,20 @@
+import frappe
+
+CACHE_KEY = "eu_einvoice:country_by_code"
+
+
+def get_country_by_code(code: str) -> str | None:
+	"""Return the name of the Country with the given ISO code, from a cached code map."""
+	countries = frappe.cache.get_value(
+		CACHE_KEY,
+		generator=lambda: dict(frappe.get_all("Country", fields=["code", "name"], as_list=True)),
+	)
+	return countries.get(code.lower())
+
+
+def clear_cache(doc=None, method=None):
+	"""Drop the cached code map.
+
+	Called via doc_events when a Country changes, and on `bench clear-cache`.
+	"""
+	frappe.cache.delete_value(CACHE_KEY)
@@ -1,17 +1,50 @@
+import sys
+from types import MappingProxyType
+
 from .utils import identity as _
 
+PROFILE_OPTIONS = "\n".join(
+	[
+		"",
+		"BASIC",
+		"EN 16931",
+		"EXTENDED",
+		"XRECHNUNG",
+	]
+)
+
 
 def get_custom_fields():
-	PROFILE_OPTIONS = "\n".join(
-		[
-			"",
-			"BASIC",
-			"EN 16931",
-			"EXTENDED",
-			"XRECHNUNG",
-		]
-	)
+	"""Return the custom fields of this app.
+
+	The structure is built once at import time and is read-only. Labels are only
+	marked for translation here (`_` is a no-op), so it does not depend on the
+	current language.
+	"""
+	return CUSTOM_FIELDS
+
 
+def _electronic_address_fields(insert_after: str) -> list[dict]:
+	"""Return the electronic address fields shared by Customer, Company and Supplier."""
+	return [
+		{
+			"fieldname": "electronic_address_scheme",
+			"label": _("Electronic Address Scheme"),
+			"insert_after": insert_after,
+			"fieldtype": "Link",
+			"options": "Common Code",
+		},
+		{
+			"fieldname": "electronic_address",
+			"label": _("Electronic Address"),
+			"insert_after": "electronic_address_scheme",
+			"fieldtype": "Data",
+			"depends_on": "electronic_address_scheme",
+		},
+	]
+
+
+def _build_custom_fields():
 	return {
 		"Purchase Invoice": [
 			{
@@ -51,20 +84,7 @@ def get_custom_fields():
 				"options": PROFILE_OPTIONS,
 				"default": "EXTENDED",
 			},
-			{
-				"fieldname": "electronic_address_scheme",
-				"label": _("Electronic Address Scheme"),
-				"insert_after": "einvoice_profile",
-				"fieldtype": "Link",
-				"options": "Common Code",
-			},
-			{
-				"fieldname": "electronic_address",
-				"label": _("Electronic Address"),
-				"insert_after": "electronic_address_scheme",
-				"fieldtype": "Data",
-				"depends_on": "electronic_address_scheme",
-			},
+			*_electronic_address_fields("einvoice_profile"),
 		],
 		"Company": [
 			{
@@ -73,20 +93,7 @@ def get_custom_fields():
 				"insert_after": "default_operating_cost_account",
 				"fieldtype": "Tab Break",
 			},
-			{
-				"fieldname": "electronic_address_scheme",
-				"label": _("Electronic Address Scheme"),
-				"insert_after": "einvoice_tab",
-				"fieldtype": "Link",
-				"options": "Common Code",
-			},
-			{
-				"fieldname": "electronic_address",
-				"label": _("Electronic Address"),
-				"insert_after": "electronic_address_scheme",
-				"fieldtype": "Data",
-				"depends_on": "electronic_address_scheme",
-			},
+			*_electronic_address_fields("einvoice_tab"),
 		],
 		"Supplier": [
 			{
@@ -95,20 +102,7 @@ def get_custom_fields():
 				"insert_after": "portal_users",
 				"fieldtype": "Tab Break",
 			},
-			{
-				"fieldname": "electronic_address_scheme",
-				"label": _("Electronic Address Scheme"),
-				"insert_after": "einvoice_tab",
-				"fieldtype": "Link",
-				"options": "Common Code",
-			},
-			{
-				"fieldname": "electronic_address",
-				"label": _("Electronic Address"),
-				"insert_after": "electronic_address_scheme",
-				"fieldtype": "Data",
-				"depends_on": "electronic_address_scheme",
-			},
+			*_electronic_address_fields("einvoice_tab"),
 		],
 		"Sales Order": [
 			{
@@ -192,3 +186,17 @@ def get_custom_fields():
 			},
 		],
 	}
+
+
+def _intern_values(field: dict) -> dict:
+	"""Intern string values, so that repeated values like fieldtypes or `insert_after`
+	share one object across all fields."""
+	return {key: sys.intern(value) if isinstance(value, str) else value for key, value in field.items()}
+
+
+CUSTOM_FIELDS = MappingProxyType(
+	{
+		doctype: tuple(MappingProxyType(_intern_values(field)) for field in fields)
+		for doctype, fields in _build_custom_fields().items()
+	}
+)
@@ -3,7 +3,12 @@ from __future__ import annotations
 import mimetypes
 import os
 import re
+import shutil
+import subprocess
+import tempfile
 from base64 import b64encode
+from functools import cache
+from io import BytesIO
 from typing import TYPE_CHECKING
 
 import frappe
@@ -14,13 +19,16 @@ from drafthorse.models.payment import PaymentTerms
 from drafthorse.models.references import AdditionalReferencedDocument
 from drafthorse.models.trade import LogisticsServiceCharge
 from drafthorse.models.tradelines import LineItem
+from drafthorse.pdf import attach_xml
 from frappe import _
 from frappe.core.doctype.file.utils import find_file_by_url
 from frappe.core.utils import html2text
 from frappe.utils.data import date_diff, flt, getdate, to_markdown
+from pypdf import PdfReader
+from pypdf.xmp import RDF_NAMESPACE
 
 from eu_einvoice.common_codes import CommonCodeRetriever
-from eu_einvoice.schematron import get_validation_errors
+from eu_einvoice.schematron import get_validation_errors, parse_xml
 from eu_einvoice.utils import EInvoiceProfile, get_drafthorse_schema, get_guideline
 
 if TYPE_CHECKING:
@@ -28,8 +36,6 @@ if TYPE_CHECKING:
 	from erpnext.accounts.doctype.sales_invoice_item.sales_invoice_item import SalesInvoiceItem
 	from erpnext.selling.doctype.customer.customer import Customer
 	from erpnext.setup.doctype.company.company import Company
-	from frappe.contacts.doctype.address.address import Address
-	from frappe.contacts.doctype.contact.contact import Contact
 
 	from eu_einvoice.european_e_invoice.doctype.e_invoice_settings.e_invoice_settings import EInvoiceSettings
 
@@ -40,6 +46,15 @@ payment_means_codes = CommonCodeRetriever(["urn:xoev-de:xrechnung:codeliste:untd
 duty_tax_fee_category_codes = CommonCodeRetriever(["urn:xoev-de:kosit:codeliste:untdid.5305_3"], "S")
 vat_exemption_reason_codes = CommonCodeRetriever(["urn:xoev-de:kosit:codeliste:vatex_1"], "vatex-eu-ae")
 
+COUNTRY_CODE_REGEX = re.compile(r"^[A-Z]{2}$")
+VAT_NUMBER_REGEX = re.compile(r"^[0-9A-Za-z\+\*\.]{2,12}$")
+FILE_NAME_TRANSLATION = str.maketrans({"/": "-"})
+GS_SEARCH_PATH_REGEX = re.compile(r"Search path:([\s\S]+) (\/.+\/lib) ([\s\S]+)Ghostscript", re.DOTALL)
+
+# Fields of Address and Contact used by the EInvoiceGenerator
+ADDRESS_FIELDS = ["address_title", "address_line1", "address_line2", "pincode", "city", "country", "email_id"]
+CONTACT_FIELDS = ["full_name", "department", "email_id", "phone", "mobile_no"]
+
 
 @frappe.whitelist()
 def download_xrechnung(invoice_id: str):
@@ -55,25 +70,14 @@ def get_einvoice(invoice: str | SalesInvoice) -> bytes:
 	invoice.check_permission("read")
 	invoice.run_method("before_einvoice_generation")
 
-	seller_address = None
-	if invoice.company_address:
-		seller_address = frappe.get_doc("Address", invoice.company_address)
-
-	buyer_address = None
-	if invoice.customer_address:
-		buyer_address = frappe.get_doc("Address", invoice.customer_address)
-
-	shipping_address = None
-	if invoice.shipping_address_name:
-		shipping_address = frappe.get_doc("Address", invoice.shipping_address_name)
-
-	seller_contact = None
-	if invoice.get("company_contact_person"):
-		seller_contact = frappe.get_doc("Contact", invoice.company_contact_person)
-
-	buyer_contact = None
-	if invoice.contact_person:
-		buyer_contact = frappe.get_doc("Contact", invoice.contact_person)
+	addresses = get_records(
+		"Address",
+		[invoice.company_address, invoice.customer_address, invoice.shipping_address_name],
+		ADDRESS_FIELDS,
+	)
+	contacts = get_records(
+		"Contact", [invoice.get("company_contact_person"), invoice.contact_person], CONTACT_FIELDS
+	)
 
 	customer = frappe.get_doc("Customer", invoice.customer)
 	company = frappe.get_doc("Company", invoice.company)
@@ -84,18 +88,33 @@ def get_einvoice(invoice: str | SalesInvoice) -> bytes:
 		invoice=invoice,
 		company=company,
 		customer=customer,
-		seller_address=seller_address,
-		buyer_address=buyer_address,
-		shipping_address=shipping_address,
-		seller_contact=seller_contact,
-		buyer_contact=buyer_contact,
+		seller_address=addresses.get(invoice.company_address),
+		buyer_address=addresses.get(invoice.customer_address),
+		shipping_address=addresses.get(invoice.shipping_address_name),
+		seller_contact=contacts.get(invoice.get("company_contact_person")),
+		buyer_contact=contacts.get(invoice.contact_person),
 	)
 	generator.create_einvoice()
 	doc = generator.get_einvoice()
 
 	invoice.run_method("after_einvoice_generation", doc)
 
-	return doc.serialize(schema=get_drafthorse_schema(profile))
+	xml_bytes = doc.serialize(schema=get_drafthorse_schema(profile))
+	# keep the result on the invoice, so that later steps in the same request don't build it again
+	invoice._einvoice_xml_bytes = xml_bytes
+	return xml_bytes
+
+
+def get_records(doctype: str, names: list[str | None], fields: list[str]) -> dict[str, frappe._dict]:
+	"""Fetch the given fields of several records in one query, keyed by name."""
+	names = [name for name in names if name]
+	if not names:
+		return {}
+
+	return {
+		row.name: row
+		for row in frappe.get_all(doctype, filters={"name": ("in", names)}, fields=["name", *fields])
+	}
 
 
 class EInvoiceGenerator:
@@ -107,13 +126,21 @@ class EInvoiceGenerator:
 		invoice: SalesInvoice,
 		company: Company,
 		customer: Customer,
-		seller_address: Address | None = None,
-		buyer_address: Address | None = None,
-		shipping_address: Address | None = None,
-		seller_contact: Contact | None = None,
-		buyer_contact: Contact | None = None,
+		seller_address: frappe._dict | None = None,
+		buyer_address: frappe._dict | None = None,
+		shipping_address: frappe._dict | None = None,
+		seller_contact: frappe._dict | None = None,
+		buyer_contact: frappe._dict | None = None,
 	):
+		"""Addresses and contacts are plain records, not documents.
+
+		They only contain the fields listed in `ADDRESS_FIELDS` and `CONTACT_FIELDS`.
+		"""
 		self.profile = profile
+		# profile checks run for every line item, compare once
+		self.is_above_basic = profile > EInvoiceProfile.BASIC
+		self.is_en16931_or_higher = profile >= EInvoiceProfile.EN16931
+		self.is_extended_or_higher = profile >= EInvoiceProfile.EXTENDED
 		self.invoice = invoice
 		self.company = company
 		self.customer = customer
@@ -125,6 +152,9 @@ class EInvoiceGenerator:
 		self.doc = None
 		self.item_tax_rates = set()
 		self.delivery_dates = []
+		self.delivery_note_dates = {}
+		self.item_precisions = {}
+		self.tax_rate_by_template = {}
 
 	def get_einvoice(self) -> Document | None:
 		"""Return the einvoice document as a Python object."""
@@ -145,21 +175,28 @@ class EInvoiceGenerator:
 		if self.invoice.po_no:
 			self.doc.trade.agreement.buyer_order.issuer_assigned_id = self.invoice.po_no
 
-			if self.invoice.po_date and self.profile >= EInvoiceProfile.EXTENDED:
+			if self.invoice.po_date and self.is_extended_or_higher:
 				self.doc.trade.agreement.buyer_order.issue_date_time = getdate(self.invoice.po_date)
 
-		if self.profile >= EInvoiceProfile.EN16931:
+		if self.is_en16931_or_higher:
 			self._embed_attachment()
 
-		sales_orders = set()
+		self._load_delivery_note_dates()
+		self._load_item_precisions()
+
+		# The seller order reference is only set if all items belong to the same Sales Order
+		so_name = None
+		multiple_sales_orders = False
 		for item in self.invoice.items:
-			if item.sales_order:
-				sales_orders.add(item.sales_order)
+			if item.sales_order and not multiple_sales_orders:
+				if so_name is None:
+					so_name = item.sales_order
+				elif item.sales_order != so_name:
+					multiple_sales_orders = True
 
 			self._add_line_item(item)
 
-		if len(sales_orders) == 1 and self.profile >= EInvoiceProfile.EXTENDED:
-			so_name = sales_orders.pop()
+		if so_name and not multiple_sales_orders and self.is_extended_or_higher:
 			self.doc.trade.agreement.seller_order.issuer_assigned_id = so_name
 			self.doc.trade.agreement.seller_order.issue_date_time = frappe.db.get_value(
 				"Sales Order", so_name, "transaction_date"
@@ -182,6 +219,31 @@ class EInvoiceGenerator:
 		self._add_payment_terms()
 		self._set_totals()
 
+	def _load_delivery_note_dates(self):
+		"""Fetch the posting dates of all Delivery Notes referenced by the items in one query."""
+		delivery_notes = list({item.delivery_note for item in self.invoice.items if item.delivery_note})
+		if not delivery_notes:
+			return
+
+		self.delivery_note_dates = dict(
+			frappe.get_all(
+				"Delivery Note",
+				filters={"name": ("in", delivery_notes)},
+				fields=["name", "posting_date"],
+				as_list=True,
+			)
+		)
+
+	def _load_item_precisions(self):
+		"""Determine the precision of the item amounts once, it is the same for all items."""
+		if not self.invoice.items:
+			return
+
+		item = self.invoice.items[0]
+		self.item_precisions = {
+			fieldname: item.precision(fieldname) for fieldname in ("net_rate", "qty", "net_amount")
+		}
+
 	def _embed_attachment(self):
 		"""Add the embedded document to the einvoice."""
 		if not self.invoice.einvoice_embedded_document:
@@ -193,7 +255,7 @@ class EInvoiceGenerator:
 		if not file.is_remote_file:
 			file_name = os.path.basename(file.file_url)
 			mime_type = mimetypes.guess_type(file.file_url)[0]
-			content = as_base_64(file.get_content())
+			content = file_as_base_64(file.get_full_path())
 
 		ref_doc = AdditionalReferencedDocument()
 		ref_doc.issuer_assigned_id = file.name
@@ -256,7 +318,7 @@ class EInvoiceGenerator:
 		self.doc.trade.agreement.seller.name = self.invoice.company
 		self._set_seller_tax_id()
 
-		if self.profile > EInvoiceProfile.BASIC:
+		if self.is_above_basic:
 			self._set_seller_contact()
 
 		self._set_seller_id()
@@ -294,14 +356,12 @@ class EInvoiceGenerator:
 		self.doc.trade.agreement.seller.address.line_two = self.seller_address.address_line2
 		self.doc.trade.agreement.seller.address.postcode = self.seller_address.pincode
 		self.doc.trade.agreement.seller.address.city_name = self.seller_address.city
-		self.doc.trade.agreement.seller.address.country_id = frappe.db.get_value(
-			"Country", self.seller_address.country, "code"
-		).upper()
+		self.doc.trade.agreement.seller.address.country_id = get_country_code(self.seller_address.country)
 
 	def _set_seller_electronic_address(self):
 		if self.company.electronic_address_scheme and self.company.electronic_address:
 			self.doc.trade.agreement.seller.electronic_address.uri_ID = (
-				frappe.db.get_value("Common Code", self.company.electronic_address_scheme, "common_code"),
+				frappe.get_cached_value("Common Code", self.company.electronic_address_scheme, "common_code"),
 				self.company.electronic_address,
 			)
 			return
@@ -325,14 +385,14 @@ class EInvoiceGenerator:
 			if self.seller_contact.phone:
 				seller_contact_phone = self.seller_contact.phone
 
-		if seller_contact_phone and self.profile >= EInvoiceProfile.EN16931:
+		if seller_contact_phone and self.is_en16931_or_higher:
 			self.doc.trade.agreement.seller.contact.telephone.number = seller_contact_phone
 
-		if self.company.fax and self.profile >= EInvoiceProfile.EXTENDED:
+		if self.company.fax and self.is_extended_or_higher:
 			self.doc.trade.agreement.seller.contact.fax.number = self.company.fax
 
 	def _set_buyer(self):
-		if frappe.db.get_single_value("Selling Settings", "cust_master_name") != "Customer Name":
+		if frappe.get_cached_doc("Selling Settings").cust_master_name != "Customer Name":
 			self.doc.trade.agreement.buyer.id = self.invoice.customer
 
 		self.doc.trade.agreement.buyer.name = self.invoice.customer_name
@@ -340,7 +400,7 @@ class EInvoiceGenerator:
 		self._set_buyer_address()
 		self._set_shipping_address()
 
-		if self.profile > EInvoiceProfile.BASIC:
+		if self.is_above_basic:
 			self._set_buyer_contact()
 
 		self._set_buyer_electronic_address()
@@ -349,7 +409,9 @@ class EInvoiceGenerator:
 	def _set_buyer_electronic_address(self):
 		if self.customer.electronic_address_scheme and self.customer.electronic_address:
 			self.doc.trade.agreement.buyer.electronic_address.uri_ID = (
-				frappe.db.get_value("Common Code", self.customer.electronic_address_scheme, "common_code"),
+				frappe.get_cached_value(
+					"Common Code", self.customer.electronic_address_scheme, "common_code"
+				),
 				self.customer.electronic_address,
 			)
 			return
@@ -384,9 +446,7 @@ class EInvoiceGenerator:
 		self.doc.trade.agreement.buyer.address.line_two = self.buyer_address.address_line2
 		self.doc.trade.agreement.buyer.address.postcode = self.buyer_address.pincode
 		self.doc.trade.agreement.buyer.address.city_name = self.buyer_address.city
-		self.doc.trade.agreement.buyer.address.country_id = frappe.db.get_value(
-			"Country", self.buyer_address.country, "code"
-		).upper()
+		self.doc.trade.agreement.buyer.address.country_id = get_country_code(self.buyer_address.country)
 
 	def _set_shipping_address(self):
 		if not self.shipping_address:
@@ -399,9 +459,7 @@ class EInvoiceGenerator:
 		self.doc.trade.delivery.ship_to.address.line_two = self.shipping_address.address_line2
 		self.doc.trade.delivery.ship_to.address.postcode = self.shipping_address.pincode
 		self.doc.trade.delivery.ship_to.address.city_name = self.shipping_address.city
-		self.doc.trade.delivery.ship_to.address.country_id = frappe.db.get_value(
-			"Country", self.shipping_address.country, "code"
-		).upper()
+		self.doc.trade.delivery.ship_to.address.country_id = get_country_code(self.shipping_address.country)
 
 	def _set_buyer_contact(self):
 		if self.buyer_contact:
@@ -411,7 +469,7 @@ class EInvoiceGenerator:
 			if self.buyer_contact.email_id:
 				self.doc.trade.agreement.buyer.contact.email.address = self.buyer_contact.email_id
 
-			if self.profile >= EInvoiceProfile.EN16931:
+			if self.is_en16931_or_higher:
 				if self.buyer_contact.phone:
 					self.doc.trade.agreement.buyer.contact.telephone.number = self.buyer_contact.phone
 				elif self.buyer_contact.mobile_no:
@@ -422,7 +480,7 @@ class EInvoiceGenerator:
 		li.document.line_id = str(item.idx)
 		li.product.name = item.item_name
 
-		if self.profile > EInvoiceProfile.BASIC:
+		if self.is_above_basic:
 			li.product.seller_assigned_id = item.item_code
 			li.product.buyer_assigned_id = item.customer_item_code
 			li.product.description = html2text(item.description)
@@ -433,90 +491,104 @@ class EInvoiceGenerator:
 		# instead sent with a positive price and a negative quantity.
 		multiplier = -1 if item.net_rate < 0 and item.qty > 0 else 1
 
-		li.agreement.net.amount = flt(item.net_rate, item.precision("net_rate")) * multiplier
+		li.agreement.net.amount = flt(item.net_rate, self.item_precisions["net_rate"]) * multiplier
 		li.delivery.billed_quantity = (
-			flt(item.qty, item.precision("qty")) * multiplier,
+			flt(item.qty, self.item_precisions["qty"]) * multiplier,
 			uom_codes.get([("UOM", item.uom)]),
 		)
 
 		if item.delivery_note:
-			posting_date = frappe.db.get_value("Delivery Note", item.delivery_note, "posting_date")
+			posting_date = self.delivery_note_dates.get(item.delivery_note)
 			self.delivery_dates.append(posting_date)
 
-			if self.profile >= EInvoiceProfile.EXTENDED:
+			if self.is_extended_or_higher:
 				li.delivery.delivery_note.issuer_assigned_id = item.delivery_note
 				li.delivery.delivery_note.issue_date_time = getdate(posting_date)
 
-		li.settlement.trade_tax.type_code = "VAT"
-		li.settlement.trade_tax.category_code = duty_tax_fee_category_codes.get(
-			[
-				("Item Tax Template", item.item_tax_template),
-				("Account", item.income_account),
-				("Tax Category", self.invoice.tax_category),
-				("Sales Taxes and Charges Template", self.invoice.taxes_and_charges),
-			]
+		# records to look up the tax category and exemption reason codes for
+		tax_records = (
+			("Item Tax Template", item.item_tax_template),
+			("Account", item.income_account),
+			("Tax Category", self.invoice.tax_category),
+			("Sales Taxes and Charges Template", self.invoice.taxes_and_charges),
 		)
+		li.settlement.trade_tax.type_code = "VAT"
+		li.settlement.trade_tax.category_code = duty_tax_fee_category_codes.get(tax_records)
 		if li.settlement.trade_tax.category_code._text in ("AE", "E", "G", "K", "Z"):
 			# BR-AE-05, BR-E-05, BR-G-05, BR-IC-05, BR-Z-05
 			li.settlement.trade_tax.rate_applicable_percent = 0
 		else:
-			item_tax_rate = get_item_rate(item.item_tax_template, self.invoice.taxes)
+			item_tax_rate = self._get_item_tax_rate(item.item_tax_template)
 			self.item_tax_rates.add(item_tax_rate)
 			li.settlement.trade_tax.rate_applicable_percent = item_tax_rate
 
 		if li.settlement.trade_tax.rate_applicable_percent._value == 0:
 			li.settlement.trade_tax.exemption_reason_code = vat_exemption_reason_codes.get(
-				[
-					("Item Tax Template", item.item_tax_template),
-					("Account", item.income_account),
-					("Tax Category", self.invoice.tax_category),
-					("Sales Taxes and Charges Template", self.invoice.taxes_and_charges),
-				]
+				tax_records
 			).upper()
 
-		li.settlement.monetary_summation.total_amount = flt(item.net_amount, item.precision("net_amount"))
+		li.settlement.monetary_summation.total_amount = flt(
+			item.net_amount, self.item_precisions["net_amount"]
+		)
 		self.doc.trade.items.add(li)
 
+	def _get_item_tax_rate(self, item_tax_template: str | None) -> float | None:
+		"""Return the tax rate for an item tax template, computed once per template."""
+		if item_tax_template not in self.tax_rate_by_template:
+			self.tax_rate_by_template[item_tax_template] = get_item_rate(
+				item_tax_template, self.invoice.taxes
+			)
+
+		return self.tax_rate_by_template[item_tax_template]
+
 	def _add_taxes_and_charges(self):
 		tax_added = False
-		for i, tax in enumerate(self.invoice.taxes):
-			if tax.charge_type == "Actual" and self.profile >= EInvoiceProfile.EXTENDED:
+		taxes = self.invoice.taxes
+		n_taxes = len(taxes)
+		tax_category = self.invoice.tax_category
+		taxes_and_charges = self.invoice.taxes_and_charges
+		settlement = self.doc.trade.settlement
+		category_codes = {}
+
+		def get_category_code(account_head: str) -> str | None:
+			# rows often share an account, look up each one once
+			if account_head not in category_codes:
+				category_codes[account_head] = duty_tax_fee_category_codes.get(
+					[
+						("Account", account_head),
+						("Tax Category", tax_category),
+						("Sales Taxes and Charges Template", taxes_and_charges),
+					]
+				)
+
+			return category_codes[account_head]
+
+		for i, tax in enumerate(taxes):
+			if tax.charge_type == "Actual" and self.is_extended_or_higher:
 				service_charge = LogisticsServiceCharge()
 				service_charge.description = tax.description
 				service_charge.applied_amount = tax.tax_amount
 
-				if len(self.invoice.taxes) > i + 1:
-					vat_line = self.invoice.taxes[i + 1]
+				if n_taxes > i + 1:
+					vat_line = taxes[i + 1]
 					if vat_line.charge_type in ("On Previous Row Amount", "On Previous Row Total"):
 						# Add applied VAT for the service charge (BR-FXEXT-S-08)
 						service_charge_tax = AppliedTradeTax()
 						service_charge_tax.type_code = "VAT"
 						service_charge_tax.rate_applicable_percent = vat_line.rate
-						service_charge_tax.category_code = duty_tax_fee_category_codes.get(
-							[
-								("Account", vat_line.account_head),
-								("Tax Category", self.invoice.tax_category),
-								("Sales Taxes and Charges Template", self.invoice.taxes_and_charges),
-							]
-						)
+						service_charge_tax.category_code = get_category_code(vat_line.account_head)
 						service_charge.trade_tax.add(service_charge_tax)
 
-				self.doc.trade.settlement.service_charge.add(service_charge)
+				settlement.service_charge.add(service_charge)
 			elif tax.charge_type == "On Net Total":
 				trade_tax = ApplicableTradeTax()
 				trade_tax.calculated_amount = tax.tax_amount
 				trade_tax.type_code = "VAT"
-				trade_tax.category_code = duty_tax_fee_category_codes.get(
-					[
-						("Account", tax.account_head),
-						("Tax Category", self.invoice.tax_category),
-						("Sales Taxes and Charges Template", self.invoice.taxes_and_charges),
-					]
-				)
+				trade_tax.category_code = get_category_code(tax.account_head)
 				tax_rate = tax.rate or frappe.db.get_value("Account", tax.account_head, "tax_rate") or 0
 				trade_tax.rate_applicable_percent = tax_rate
 
-				if len(self.invoice.taxes) == 1:
+				if n_taxes == 1:
 					# We only have one tax, so we can use the net total as basis amount
 					trade_tax.basis_amount = self.invoice.net_total
 					if len(self.item_tax_rates) == 1 and tax_rate == 0:
@@ -533,51 +605,39 @@ class EInvoiceGenerator:
 				else:
 					trade_tax.basis_amount = 0
 
-				self.doc.trade.settlement.trade_tax.add(trade_tax)
+				settlement.trade_tax.add(trade_tax)
 				tax_added = True
 			elif tax.charge_type == "On Previous Row Amount":
 				trade_tax = ApplicableTradeTax()
-				trade_tax.basis_amount = self.invoice.taxes[i - 1].tax_amount
+				trade_tax.basis_amount = taxes[i - 1].tax_amount
 				trade_tax.rate_applicable_percent = tax.rate
 				trade_tax.calculated_amount = tax.tax_amount
 
-				if self.invoice.taxes[i - 1].charge_type == "Actual":
+				if taxes[i - 1].charge_type == "Actual":
 					# VAT for a LogisticsServiceCharge
 					trade_tax.type_code = "VAT"
 				else:
 					# A tax or duty applied on and in addition to existing duties and taxes.
 					trade_tax.type_code = "SUR"
 
-				trade_tax.category_code = duty_tax_fee_category_codes.get(
-					[
-						("Account", tax.account_head),
-						("Tax Category", self.invoice.tax_category),
-						("Sales Taxes and Charges Template", self.invoice.taxes_and_charges),
-					]
-				)
-				self.doc.trade.settlement.trade_tax.add(trade_tax)
+				trade_tax.category_code = get_category_code(tax.account_head)
+				settlement.trade_tax.add(trade_tax)
 				tax_added = True
 			elif tax.charge_type == "On Previous Row Total":
 				trade_tax = ApplicableTradeTax()
-				trade_tax.basis_amount = self.invoice.taxes[i - 1].total
+				trade_tax.basis_amount = taxes[i - 1].total
 				trade_tax.rate_applicable_percent = tax.rate
 				trade_tax.calculated_amount = tax.tax_amount
 
-				if self.invoice.taxes[i - 1].charge_type == "Actual":
+				if taxes[i - 1].charge_type == "Actual":
 					# VAT for a LogisticsServiceCharge
 					trade_tax.type_code = "VAT"
 				else:
 					# A tax or duty applied on and in addition to existing duties and taxes.
 					trade_tax.type_code = "SUR"
 
-				trade_tax.category_code = duty_tax_fee_category_codes.get(
-					[
-						("Account", tax.account_head),
-						("Tax Category", self.invoice.tax_category),
-						("Sales Taxes and Charges Template", self.invoice.taxes_and_charges),
-					]
-				)
-				self.doc.trade.settlement.trade_tax.add(trade_tax)
+				trade_tax.category_code = get_category_code(tax.account_head)
+				settlement.trade_tax.add(trade_tax)
 				tax_added = True
 
 		return tax_added
@@ -605,7 +665,7 @@ class EInvoiceGenerator:
 
 	def _add_delivery_date(self):
 		if self.delivery_dates:
-			delivery_date = sorted(self.delivery_dates)[-1]
+			delivery_date = max(self.delivery_dates)
 		elif self.invoice.to_date:
 			delivery_date = self.invoice.to_date
 		else:
@@ -661,25 +721,34 @@ class EInvoiceGenerator:
 			+ [("Mode of Payment", term.mode_of_payment) for term in self.invoice.payment_schedule]
 		)
 
-		modes_of_payment = {ps.mode_of_payment for ps in self.invoice.payment_schedule if ps.mode_of_payment}
-		for mode_of_payment in modes_of_payment:
-			iban, bic = get_bank_details(mode_of_payment, self.invoice.company)
-			if not iban:
-				continue
+		# Only one mode of payment is considered (see validate_doc), use the first one in the schedule
+		mode_of_payment = next(
+			(ps.mode_of_payment for ps in self.invoice.payment_schedule if ps.mode_of_payment), None
+		)
+		if not mode_of_payment:
+			return
 
-			self.doc.trade.settlement.payment_means.payee_account.iban = iban
+		iban, bic = get_bank_details(mode_of_payment, self.invoice.company)
+		if not iban:
+			return
 
-			if self.profile >= EInvoiceProfile.EN16931:
-				self.doc.trade.settlement.payment_means.payee_account.account_name = self.invoice.company
-				self.doc.trade.settlement.payment_means.payee_institution.bic = bic
+		self.doc.trade.settlement.payment_means.payee_account.iban = iban
 
-			break
+		if self.is_en16931_or_higher:
+			self.doc.trade.settlement.payment_means.payee_account.account_name = self.invoice.company
+			self.doc.trade.settlement.payment_means.payee_institution.bic = bic
 
 	def _set_totals(self):
 		# [BR-DEC-09]-The allowed maximum number of decimals for the Sum of Invoice line net amount (BT-106) is 2.
 		self.doc.trade.settlement.monetary_summation.line_total = flt(self.invoice.net_total, 2)
 
-		actual_charge_total = sum(tax.tax_amount for tax in self.invoice.taxes if tax.charge_type == "Actual")
+		actual_charge_total = tax_total = 0
+		for tax in self.invoice.taxes:
+			if tax.charge_type == "Actual":
+				actual_charge_total += tax.tax_amount
+			else:
+				tax_total += tax.tax_amount
+
 		if actual_charge_total:
 			# [BR-DEC-11]-The allowed maximum number of decimals for the Sum of charges on document level (BT-108) is 2.
 			self.doc.trade.settlement.monetary_summation.charge_total = flt(actual_charge_total, 2)
@@ -689,7 +758,6 @@ class EInvoiceGenerator:
 			self.invoice.net_total + actual_charge_total, 2
 		)
 
-		tax_total = sum(tax.tax_amount for tax in self.invoice.taxes if tax.charge_type != "Actual")
 		# [BR-DEC-13]-The allowed maximum number of decimals for the Invoice total VAT amount (BT-110) is 2.
 		self.doc.trade.settlement.monetary_summation.tax_total_other_currency.add(
 			(flt(tax_total, 2), self.invoice.currency)
@@ -709,17 +777,14 @@ class EInvoiceGenerator:
 
 
 def validate_vat_id(vat_id: str) -> tuple[str, str]:
-	COUNTRY_CODE_REGEX = r"^[A-Z]{2}$"
-	VAT_NUMBER_REGEX = r"^[0-9A-Za-z\+\*\.]{2,12}$"
-
 	country_code = vat_id[:2].upper()
 	vat_number = vat_id[2:].replace(" ", "")
 
 	# check vat_number and country_code with regex
-	if not re.match(COUNTRY_CODE_REGEX, country_code):
+	if not COUNTRY_CODE_REGEX.match(country_code):
 		raise ValueError("Invalid country code")
 
-	if not re.match(VAT_NUMBER_REGEX, vat_number):
+	if not VAT_NUMBER_REGEX.match(vat_number):
 		raise ValueError("Invalid VAT number")
 
 	return country_code + vat_number
@@ -749,7 +814,8 @@ def validate_doc(doc, event):
 				indicator="orange",
 			)
 
-	modes_of_payment = set()
+	mode_of_payment = None
+	multiple_modes_of_payment = False
 	for ps in doc.payment_schedule:
 		if ps.discount_date and date_diff(ps.discount_date, doc.posting_date) < 0:
 			frappe.msgprint(
@@ -760,10 +826,13 @@ def validate_doc(doc, event):
 				indicator="orange",
 			)
 
-		if ps.mode_of_payment:
-			modes_of_payment.add(ps.mode_of_payment)
+		if ps.mode_of_payment and not multiple_modes_of_payment:
+			if mode_of_payment is None:
+				mode_of_payment = ps.mode_of_payment
+			elif ps.mode_of_payment != mode_of_payment:
+				multiple_modes_of_payment = True
 
-	if len(modes_of_payment) > 1:
+	if multiple_modes_of_payment:
 		frappe.msgprint(
 			_("{0}: Only one mode of payment will be considered in the e-invoice.").format(
 				_(doc.meta.get_label("payment_schedule"))
@@ -802,7 +871,6 @@ def validate_einvoice(doc: SalesInvoice):
 
 	try:
 		xml_bytes = get_einvoice(doc)
-		doc._einvoice_xml_bytes = xml_bytes
 		xml_string = xml_bytes.decode()
 	except Exception:
 		msg = _("Cannot create E Invoice.")
@@ -812,10 +880,11 @@ def validate_einvoice(doc: SalesInvoice):
 
 	try:
 		invoice_profile = EInvoiceProfile(doc.einvoice_profile)
-		validation_errors, warnings = get_validation_errors(xml_string, invoice_profile)
+		xml_node = parse_xml(xml_string)
+		validation_errors, warnings = get_validation_errors(xml_node, invoice_profile)
 
 		if invoice_profile == EInvoiceProfile.XRECHNUNG:
-			basic_errors, basic_warnings = get_validation_errors(xml_string, EInvoiceProfile.EN16931)
+			basic_errors, basic_warnings = get_validation_errors(xml_node, EInvoiceProfile.EN16931)
 			validation_errors += basic_errors
 			warnings += basic_warnings
 	except Exception:
@@ -851,7 +920,7 @@ def attach_xml_on_submit(doc: SalesInvoice, event: str):
 	try:
 		xml_content = getattr(doc, "_einvoice_xml_bytes", None) or get_einvoice(doc)
 	except Exception:
-		doc.log_error("E Invoice Auto-Attach Failed")
+		_log_attach_error(doc, "E Invoice Auto-Attach Failed")
 		# Don't raise exception - allow submit to continue even if attachment fails
 		return
 
@@ -860,7 +929,7 @@ def attach_xml_on_submit(doc: SalesInvoice, event: str):
 	try:
 		_attach_xml_file(doc, xml_content, field_name)
 	except Exception:
-		doc.log_error("E Invoice Auto-Attach File Creation Failed")
+		_log_attach_error(doc, "E Invoice Auto-Attach File Creation Failed")
 		# Don't raise exception - allow submit to continue
 		return
 
@@ -875,25 +944,27 @@ def _attach_xml_file(doc: SalesInvoice, xml_content: bytes, field_name: str | No
 	    field_name: Target attachment field name (None for general attachment)
 	"""
 	if not xml_content:
-		doc.log_error("E Invoice Auto-Attach: Empty XML content")
+		_log_attach_error(doc, "E Invoice Auto-Attach: Empty XML content")
 		return
 
 	if field_name:
 		if not hasattr(doc, field_name):
-			doc.log_error(
+			_log_attach_error(
+				doc,
 				title="E Invoice Auto-Attach: invalid field",
 				message=f"Field '{field_name}' is configured for XML attachment, but does not exist on the document.",
 			)
 			return
 
 		if doc.get(field_name):
-			doc.log_error(
+			_log_attach_error(
+				doc,
 				title="E Invoice Auto-Attach: conflicting value",
 				message=f"Field '{field_name}' is configured for XML attachment, but already has a value.",
 			)
 			return
 
-	file_name = f"{doc.name}.xml".replace("/", "-")
+	file_name = f"{doc.name}.xml".translate(FILE_NAME_TRANSLATION)
 
 	# Create new File document
 	file_doc = frappe.new_doc("File")
@@ -913,15 +984,30 @@ def _attach_xml_file(doc: SalesInvoice, xml_content: bytes, field_name: str | No
 
 	# Update field value on Sales Invoice only if field is specified
 	if field_name:
-		doc.db_set(field_name, file_doc.file_url)
+		# runs in on_submit, after the invoice row has been written
+		doc.db_set(field_name, file_doc.file_url, update_modified=False)
+
+
+def _log_attach_error(doc: SalesInvoice, title: str, message: str | None = None):
+	"""Log a non-fatal auto-attach problem without an extra insert during submit.
+
+	The Error Log is queued and written in bulk by the scheduler.
+	"""
+	frappe.log_error(
+		title=title,
+		message=message,
+		reference_doctype=doc.doctype,
+		reference_name=doc.name,
+		defer_insert=True,
+	)
 
 
 def get_item_rate(item_tax_template: str | None, taxes: list[dict]) -> float | None:
 	"""Get the tax rate for an item from the item tax template and the taxes table."""
 	if item_tax_template:
 		# match the accounts from the taxes table with the rate from the item tax template
-		tax_template = frappe.get_doc("Item Tax Template", item_tax_template)
-		applicable_accounts = [tax.account_head for tax in taxes if tax.account_head]
+		tax_template = frappe.get_cached_doc("Item Tax Template", item_tax_template)
+		applicable_accounts = {tax.account_head for tax in taxes if tax.account_head}
 
 		for item_tax in tax_template.taxes:
 			if item_tax.tax_type in applicable_accounts:
@@ -950,38 +1036,68 @@ def get_skonto_line(days: int, percent: float, basis_amount: float | None = None
 	return "#" + "#".join(parts) + "#"
 
 
-def get_bank_details(mode_of_payment: str, company: str) -> tuple[str | None, str | None]:
-	"""Get the bank details for a mode of payment."""
-	empty_tuple = (None, None)
-	if frappe.db.get_value("Mode of Payment", mode_of_payment, "type") != "Bank":
-		return empty_tuple
+def get_country_code(country: str) -> str:
+	"""Return the upper case ISO code of a Country, read from the document cache."""
+	return frappe.get_cached_value("Country", country, "code").upper()
 
-	account = frappe.db.get_value(
-		"Mode of Payment Account", {"parent": mode_of_payment, "company": company}, "default_account"
-	)
-	if not account:
-		return empty_tuple
-
-	bank_account_name = frappe.db.get_value(
-		"Bank Account", {"account": account, "company": company, "is_company_account": 1, "disabled": 0}
-	)
-	if not bank_account_name:
-		return empty_tuple
 
-	iban, bank = frappe.db.get_value("Bank Account", bank_account_name, ["iban", "bank"])
-	if not iban:
-		return empty_tuple
+def get_bank_details(mode_of_payment: str, company: str) -> tuple[str | None, str | None]:
+	"""Get the bank details for a mode of payment."""
+	ModeOfPayment = frappe.qb.DocType("Mode of Payment")
+	ModeOfPaymentAccount = frappe.qb.DocType("Mode of Payment Account")
+	BankAccount = frappe.qb.DocType("Bank Account")
+	Bank = frappe.qb.DocType("Bank")
+	rows = (
+		frappe.qb.from_(ModeOfPayment)
+		.join(ModeOfPaymentAccount)
+		.on(ModeOfPaymentAccount.parent == ModeOfPayment.name)
+		.join(BankAccount)
+		.on(BankAccount.account == ModeOfPaymentAccount.default_account)
+		.left_join(Bank)
+		.on(Bank.name == BankAccount.bank)
+		.select(BankAccount.iban, Bank.swift_number)
+		.where(
+			(ModeOfPayment.name == mode_of_payment)
+			& (ModeOfPayment.type == "Bank")
+			& (ModeOfPaymentAccount.company == company)
+			& (BankAccount.company == company)
+			& (BankAccount.is_company_account == 1)
+			& (BankAccount.disabled == 0)
+		)
+		.limit(1)
+	).run()
+	if not rows or not rows[0][0]:
+		return (None, None)
 
-	bic = frappe.db.get_value("Bank", bank, "swift_number") if bank else None
+	iban, bic = rows[0]
 	return (iban, bic or None)
 
 
-def as_base_64(content: str | bytes) -> str:
-	"""Convert a string or bytes object to a base64-encoded string."""
+def as_base_64(content: str | bytes | bytearray | memoryview) -> str:
+	"""Convert a string or bytes-like object to a base64-encoded string.
+
+	Bytes-like objects are encoded without being copied first.
+	"""
 	if isinstance(content, str):
 		content = content.encode("utf-8")
 
-	return b64encode(content).decode("utf-8")
+	return b64encode(content).decode("ascii")
+
+
+def file_as_base_64(path: str) -> str:
+	"""Return the base64-encoded content of a file, without holding a second raw copy in memory.
+
+	The file is read in chunks whose size is a multiple of 3, so the encoded chunks
+	can be concatenated without padding in between.
+	"""
+	buffer = bytearray(3 * 64 * 1024)
+	view = memoryview(buffer)
+	encoded = bytearray()
+	with open(path, "rb") as f:
+		while size := f.readinto(buffer):
+			encoded += b64encode(view[:size])
+
+	return encoded.decode("ascii")
 
 
 @frappe.whitelist(allow_guest=True)
@@ -1008,13 +1124,10 @@ def download_pdf(
 			frappe.local.response.filecontent = zugferd_pdf
 
 
+@cache
 def _get_icc_profile_path() -> str:
 	"""Get the path to the ICC profile used by Ghostscript."""
-	import os
-	import re
-	import subprocess
-
-	gs_output = subprocess.run(["gs", "-h"], capture_output=True, text=True)
+	gs_output = subprocess.run(["gs", "-h"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
 	# the output of `gs -h` contains the search paths for Ghostscript
 	# it looks like the following:
 	# ...
@@ -1027,9 +1140,7 @@ def _get_icc_profile_path() -> str:
 	#   /usr/local/lib/ghostscript/fonts : /usr/share/fonts
 	# Ghostscript is also using fontconfig to search for font files
 	# ...
-	search_paths = re.search(
-		r"Search path:([\s\S]+) (\/.+\/lib) ([\s\S]+)Ghostscript", gs_output.stdout, re.DOTALL
-	)
+	search_paths = GS_SEARCH_PATH_REGEX.search(gs_output.stdout)
 	if not search_paths:
 		raise RuntimeError("Unable to find /lib path in Ghostscript search paths")
 
@@ -1044,8 +1155,8 @@ def _get_icc_profile_path() -> str:
 
 def _convert_pdf_to_pdfa(pdf_data: bytes) -> bytes:
 	"""Convert the PDF data to PDF/A-3 using Ghostscript."""
-	import os
-	import subprocess
+	if _is_pdfa3(pdf_data):
+		return pdf_data
 
 	cwd = None
 	if not os.path.isfile("srgb.icc"):
@@ -1053,37 +1164,66 @@ def _convert_pdf_to_pdfa(pdf_data: bytes) -> bytes:
 		# if it is not present, change the current working directory to the icc profile path.
 		cwd = _get_icc_profile_path()
 
-	with subprocess.Popen(
-		[
-			"gs",
-			"-q",
-			"-sstdout=%stderr",
-			"-dPDFA=3",
-			"-dBATCH",
-			"-dNOPAUSE",
-			"-dPDFACompatibilityPolicy=2",
-			"-sColorConversionStrategy=RGB",
-			"--permit-file-read=srgb.icc",
-			"-sDEVICE=pdfwrite",
-			"-sOutputFile=-",
-			"PDFA_def.ps",
-			"-",
-		],
-		cwd=cwd,
-		stdin=subprocess.PIPE,
-		stdout=subprocess.PIPE,
-		stderr=subprocess.PIPE,
-	) as proc:
-		pdfa_data, err = proc.communicate(input=pdf_data)
-		if proc.returncode != 0:
-			raise RuntimeError(f"Ghostscript error: {err.decode()}")
-		return pdfa_data
+	# Ghostscript needs random access to the input PDF and spools stdin to a
+	# temporary file anyway, so we hand it a file (with an absolute path) directly.
+	with tempfile.NamedTemporaryFile(suffix=".pdf") as input_file:
+		input_file.write(pdf_data)
+		input_file.flush()
 
+		with subprocess.Popen(
+			[
+				"gs",
+				"-q",
+				"-sstdout=%stderr",
+				"-dPDFA=3",
+				"-dBATCH",
+				"-dNOPAUSE",
+				"-dPDFACompatibilityPolicy=2",
+				"-sColorConversionStrategy=RGB",
+				"--permit-file-read=srgb.icc",
+				"-sDEVICE=pdfwrite",
+				"-sOutputFile=-",
+				"PDFA_def.ps",
+				input_file.name,
+			],
+			cwd=cwd,
+			stdin=subprocess.DEVNULL,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.PIPE,
+		) as proc:
+			pdfa_data, err = proc.communicate()
+			if proc.returncode != 0:
+				raise RuntimeError(f"Ghostscript error: {err.decode()}")
+			return pdfa_data
+
+
+def _is_pdfa3(pdf_data: bytes) -> bool:
+	"""Check whether the XMP metadata of the PDF declares PDF/A-3 conformance."""
+	pdfaid_namespace = "http://www.aiim.org/pdfa/ns/id/"
+
+	try:
+		xmp = PdfReader(BytesIO(pdf_data)).xmp_metadata
+	except Exception:
+		return False
+
+	if not xmp:
+		return False
+
+	for description in xmp.rdf_root.getElementsByTagNameNS(RDF_NAMESPACE, "Description"):
+		# pdfaid:part can be written as an attribute or as a child element
+		part = description.getAttributeNS(pdfaid_namespace, "part")
+		for element in description.getElementsByTagNameNS(pdfaid_namespace, "part"):
+			part = "".join(node.data for node in element.childNodes if node.nodeType == node.TEXT_NODE)
 
+		if part.strip() == "3":
+			return True
+
+	return False
+
+
+@cache
 def _is_ghostscript_installed() -> bool:
 	"""Check if Ghostscript is installed on the system."""
-	import shutil
-
 	return shutil.which("gs") is not None
 
 
@@ -1094,8 +1234,6 @@ def attach_xml_to_pdf(invoice_id: str, pdf_data: bytes) -> bytes:
 	    invoice_id: The name of the Sales Invoice.
 	    pdf_data: The PDF data as bytes.
 	"""
-	from drafthorse.pdf import attach_xml
-
 	if _is_ghostscript_installed():
 		try:
 			pdf_data = _convert_pdf_to_pdfa(pdf_data)
@@ -2,19 +2,23 @@
 # For license information, please see license.txt
 
 
+import hashlib
+from collections import defaultdict
+from collections.abc import Iterable
 from pathlib import Path
 from typing import TYPE_CHECKING
 
 import frappe
 from drafthorse.models.document import Document as DrafthorseDocument
 from erpnext import get_default_company
-from erpnext.edi.doctype.code_list.code_list import get_docnames_for
 from facturx import get_xml_from_pdf
 from frappe import _, _dict, get_site_path
 from frappe.model.document import Document
 from frappe.model.mapper import get_mapped_doc
 from lxml.etree import XMLSyntaxError
 
+from eu_einvoice.common_codes import get_docnames_for_codes
+from eu_einvoice.countries import get_country_by_code
 from eu_einvoice.schematron import get_validation_errors
 from eu_einvoice.utils import EInvoiceProfile, get_profile
 
@@ -63,6 +67,7 @@ class EInvoiceImport(Document):
 		due_payable: DF.Currency
 		e_invoice_is_correct: DF.Check
 		einvoice: DF.Attach | None
+		einvoice_hash: DF.Data | None
 		grand_total: DF.Currency
 		id: DF.Data | None
 		issue_date: DF.Date | None
@@ -106,11 +111,17 @@ class EInvoiceImport(Document):
 
 	def before_save(self):
 		if self.einvoice and self.has_value_changed("einvoice"):
-			self.read_values_from_einvoice()
-			self.guess_supplier()
-			self.guess_company()
-			self.guess_uom()
-			self.guess_item_code()
+			xml_bytes = self.get_xml_bytes()
+			einvoice_hash = hashlib.blake2b(xml_bytes, digest_size=16).hexdigest()
+			# if the same e-invoice was attached again, its values have been read already
+			if einvoice_hash != self.einvoice_hash:
+				is_validated = self.read_values_from_einvoice(xml_bytes)
+				# remember the e-invoice only once it is validated, so a failed validation is retried
+				self.einvoice_hash = einvoice_hash if is_validated else None
+				self.guess_supplier()
+				self.guess_company()
+				self.guess_uom()
+				self.guess_item_code()
 
 		self.guess_po_details()
 
@@ -131,6 +142,14 @@ class EInvoiceImport(Document):
 		if self.docstatus == 0:
 			return
 
+		linked_invoice = self.get_purchase_invoice(e_invoice_import=self.name)
+		unlinked_invoice = self.get_purchase_invoice(e_invoice_import=("is", "not set"))
+
+		self.set_onload("linked_invoice", linked_invoice)
+		self.set_onload("unlinked_invoice", unlinked_invoice)
+
+	def get_purchase_invoice(self, **filters) -> str | None:
+		"""Return the first non-cancelled Purchase Invoice for this bill that matches the filters."""
 		invoices = frappe.get_list(
 			"Purchase Invoice",
 			filters={
@@ -138,29 +157,28 @@ class EInvoiceImport(Document):
 				"supplier": self.supplier,
 				"company": self.company,
 				"docstatus": ("!=", 2),
+				**filters,
 			},
-			fields=["name", "e_invoice_import"],
+			pluck="name",
+			limit=1,
 		)
-		linked_invoice = next(
-			(invoice.name for invoice in invoices if invoice.e_invoice_import == self.name), None
-		)
-		unlinked_invoice = next((invoice.name for invoice in invoices if not invoice.e_invoice_import), None)
-
-		self.set_onload("linked_invoice", linked_invoice)
-		self.set_onload("unlinked_invoice", unlinked_invoice)
+		return invoices[0] if invoices else None
 
 	def get_xml_bytes(self) -> bytes:
 		return get_xml_bytes(self.einvoice)
 
-	def read_values_from_einvoice(self) -> None:
-		xml_bytes = self.get_xml_bytes()
+	def read_values_from_einvoice(self, xml_bytes: bytes | None = None) -> bool:
+		"""Read the values from the e-invoice. Return whether the schematron validation ran."""
+		if xml_bytes is None:
+			xml_bytes = self.get_xml_bytes()
+
 		try:
 			doc = DrafthorseDocument.parse(xml_bytes, strict=False)
 		except XMLSyntaxError:
 			frappe.throw(_("The uploaded file does not contain valid XML data."))
 
 		self.profile = get_profile(doc.context.guideline_parameter.id._text).value
-		self._validate_schematron(xml_bytes)
+		is_validated = self._validate_schematron(xml_bytes)
 
 		self.id = str(doc.header.id)
 		self.issue_date = str(doc.header.issue_date_time)
@@ -179,6 +197,7 @@ class EInvoiceImport(Document):
 		self.items = []
 		for li in doc.trade.items.children:
 			self.parse_line_item(li)
+		self.clear_unknown_items()
 
 		self.taxes = []
 		for tax in doc.trade.settlement.trade_tax.children:
@@ -192,7 +211,9 @@ class EInvoiceImport(Document):
 		self.parse_bank_details(doc.trade.settlement.payment_means)
 		self.parse_billing_period(doc.trade.settlement.period)
 
-	def _validate_schematron(self, xml_bytes):
+		return is_validated
+
+	def _validate_schematron(self, xml_bytes) -> bool:
 		self.validation_errors = ""
 		self.validation_warnings = ""
 		xml_string = xml_bytes.decode("utf-8")
@@ -212,16 +233,21 @@ class EInvoiceImport(Document):
 				alert=True,
 				indicator="orange",
 			)
-			return
+			return False
 
-		if any(validation_errors):
+		# messages are stripped, so the joined text is blank only if every message is empty
+		errors_text = "\n".join(validation_errors)
+		if errors_text.strip():
 			self.e_invoice_is_correct = 0
-			self.validation_errors += "\n".join(validation_errors)
+			self.validation_errors = errors_text
 		else:
 			self.e_invoice_is_correct = 1
 
-		if any(validation_warnings):
-			self.validation_warnings += "\n".join(validation_warnings)
+		warnings_text = "\n".join(validation_warnings)
+		if warnings_text.strip():
+			self.validation_warnings = warnings_text
+
+		return True
 
 	def parse_seller(self, seller: TradeParty):
 		self.seller_name = str(seller.name)
@@ -239,7 +265,7 @@ class EInvoiceImport(Document):
 		self.parse_address(buyer.address, "buyer")
 
 	def parse_address(self, address: PostalTradeAddress, prefix: str) -> _dict:
-		country = frappe.db.get_value("Country", {"code": str(address.country_id).lower()}, "name")
+		country = get_country_by_code(str(address.country_id))
 
 		self.set(f"{prefix}_city", str(address.city_name))
 		self.set(f"{prefix}_address_line_1", str(address.line_one))
@@ -258,22 +284,35 @@ class EInvoiceImport(Document):
 		product_description = str(li.product.description)
 		if len(product_name_full) > 140:
 			item.product_name = product_name_full[:140]
-			item.product_description = product_name_full + " | " + product_description
+			item.product_description = f"{product_name_full} | {product_description}"
 		else:
 			item.product_name = product_name_full
 			item.product_description = product_description
 		item.seller_product_id = str(li.product.seller_assigned_id)
-		item_code = str(li.product.buyer_assigned_id)
-		if item_code and not frappe.db.exists("Item", item_code):
-			item_code = None
-
-		item.item = item_code or None
+		# checked against existing items for all lines at once, in `clear_unknown_items`
+		item.item = str(li.product.buyer_assigned_id) or None
 		item.billed_quantity = flt_or_none(li.delivery.billed_quantity._amount)
 		item.unit_code = str(li.delivery.billed_quantity._unit_code)
 		item.net_rate = rate
 		item.tax_rate = flt_or_none(li.settlement.trade_tax.rate_applicable_percent._value)
 		item.total_amount = flt_or_none(li.settlement.monetary_summation.total_amount._value)
 
+	def clear_unknown_items(self):
+		"""Unset item codes from the e-invoice that don't exist in the system."""
+		item_codes = {row.item for row in self.items if row.item}
+		if not item_codes:
+			return
+
+		# MariaDB may match names case-insensitively, Postgres doesn't. Either way, link
+		# the name as it is stored, so that the link validation passes on both.
+		existing_items = {
+			name.casefold(): name
+			for name in frappe.get_all("Item", filters={"name": ("in", list(item_codes))}, pluck="name")
+		}
+		for row in self.items:
+			if row.item:
+				row.item = existing_items.get(row.item.casefold())
+
 	def parse_tax(self, tax: ApplicableTradeTax):
 		t = self.append("taxes")
 		t.basis_amount = flt_or_none(tax.basis_amount._value)
@@ -337,11 +376,27 @@ class EInvoiceImport(Document):
 		if self.supplier:
 			return
 
-		if frappe.db.exists("Supplier", self.seller_name):
-			self.supplier = self.seller_name
+		or_filters = {}
+		if self.seller_name:
+			or_filters["name"] = self.seller_name
+		if self.seller_tax_id:
+			or_filters["tax_id"] = self.seller_tax_id
+		if not or_filters:
+			return
 
+		# the database compares case-insensitively, so we do as well
+		suppliers = frappe.get_all("Supplier", or_filters=or_filters, fields=["name", "tax_id"])
 		if self.seller_tax_id:
-			self.supplier = frappe.db.get_value("Supplier", {"tax_id": self.seller_tax_id}, "name")
+			# a match by tax ID takes precedence over the name
+			tax_id = self.seller_tax_id.casefold()
+			matches = [
+				supplier.name for supplier in suppliers if (supplier.tax_id or "").casefold() == tax_id
+			]
+		else:
+			seller_name = self.seller_name.casefold()
+			matches = [supplier.name for supplier in suppliers if supplier.name.casefold() == seller_name]
+
+		self.supplier = matches[0] if matches else None
 
 	def guess_company(self):
 		if self.company:
@@ -353,33 +408,46 @@ class EInvoiceImport(Document):
 			self.company = get_default_company()
 
 	def guess_uom(self):
+		uoms = get_docnames_for_codes(
+			["urn:xoev-de:kosit:codeliste:rec20_3", "urn:xoev-de:kosit:codeliste:rec21_3"],
+			"UOM",
+			(row.unit_code for row in self.items if not row.uom and row.unit_code),
+		)
+		item_uoms = get_item_uoms(
+			row.item for row in self.items if not row.uom and not row.unit_code and row.item
+		)
 		for row in self.items:
 			if row.uom:
 				continue
 
 			if row.unit_code:
-				rec20_3 = get_docnames_for("urn:xoev-de:kosit:codeliste:rec20_3", "UOM", row.unit_code)
-				if rec20_3:
-					row.uom = rec20_3[0]
-				else:
-					rec21_3 = get_docnames_for("urn:xoev-de:kosit:codeliste:rec21_3", "UOM", row.unit_code)
-					if rec21_3:
-						row.uom = rec21_3[0]
+				row.uom = uoms.get(row.unit_code.casefold())
 			elif row.item:
-				stock_uom, purchase_uom = frappe.db.get_value("Item", row.item, ["stock_uom", "purchase_uom"])
-				row.uom = purchase_uom or stock_uom
+				row.uom = item_uoms.get(row.item)
 
 	def guess_item_code(self):
-		for row in self.items:
-			if row.item:
-				continue
+		if not self.supplier:
+			return
 
-			if row.seller_product_id and self.supplier:
-				row.item = frappe.db.get_value(
-					"Item Supplier",
-					{"supplier": self.supplier, "supplier_part_no": row.seller_product_id},
-					"parent",
-				)
+		seller_product_ids = {
+			row.seller_product_id for row in self.items if not row.item and row.seller_product_id
+		}
+		if not seller_product_ids:
+			return
+
+		# the database may match part numbers case-insensitively, so we do as well
+		items = {}
+		for supplier_part_no, item in frappe.get_all(
+			"Item Supplier",
+			filters={"supplier": self.supplier, "supplier_part_no": ("in", list(seller_product_ids))},
+			fields=["supplier_part_no", "parent"],
+			as_list=True,
+		):
+			items.setdefault(supplier_part_no.casefold(), item)
+
+		for row in self.items:
+			if not row.item and row.seller_product_id:
+				row.item = items.get(row.seller_product_id.casefold())
 
 	def guess_po_details(self):
 		if not self.purchase_order:
@@ -387,23 +455,28 @@ class EInvoiceImport(Document):
 				pi_row.po_detail = None
 			return
 
-		purchase_order = frappe.get_doc("Purchase Order", self.purchase_order)
-		po_items = [
-			frappe._dict(
-				name=po_row.name,
-				item_code=po_row.item_code,
-				unbilled_amount=po_row.amount - po_row.billed_amt,
+		po_items_by_item_code = defaultdict(list)
+		po_detail_names = set()
+		for po_row in frappe.get_all(
+			"Purchase Order Item",
+			filters={"parent": self.purchase_order, "parenttype": "Purchase Order"},
+			fields=["name", "item_code", "amount", "billed_amt"],
+			order_by="idx",
+		):
+			po_items_by_item_code[po_row.item_code].append(
+				frappe._dict(
+					name=po_row.name,
+					unbilled_amount=po_row.amount - po_row.billed_amt,
+				)
 			)
-			for po_row in purchase_order.items
-		]
+			po_detail_names.add(po_row.name)
+
 		for pi_row in self.items:
-			if pi_row.po_detail and frappe.db.exists(
-				"Purchase Order Item", {"name": pi_row.po_detail, "parent": self.purchase_order}
-			):
+			if pi_row.po_detail in po_detail_names:
 				continue
 
-			for po_row in po_items:
-				if po_row.item_code == pi_row.item and po_row.unbilled_amount >= pi_row.total_amount:
+			for po_row in po_items_by_item_code.get(pi_row.item, ()):
+				if po_row.unbilled_amount >= pi_row.total_amount:
 					pi_row.po_detail = po_row.name
 					po_row.unbilled_amount -= pi_row.total_amount
 					break
@@ -428,6 +501,23 @@ def flt_or_none(value) -> float | None:
 	return float(value) if value is not None else None
 
 
+def get_item_uoms(items: Iterable[str]) -> dict[str, str]:
+	"""Return the purchase UOM, or else the stock UOM, of each item, fetched in a single query."""
+	items = list(set(items))
+	if not items:
+		return {}
+
+	return {
+		item: purchase_uom or stock_uom
+		for item, stock_uom, purchase_uom in frappe.get_all(
+			"Item",
+			filters={"name": ("in", items)},
+			fields=["name", "stock_uom", "purchase_uom"],
+			as_list=True,
+		)
+	}
+
+
 def get_xml_bytes(einvoice: str) -> bytes:
 	"""Reads the XML data from the attached XML or PDF file."""
 	CREATE_PI_ACTION = {
@@ -437,7 +527,10 @@ def get_xml_bytes(einvoice: str) -> bytes:
 
 	file = relative_url_to_path(einvoice)
 	if file.suffix.lower() == ".pdf":
-		xml_filename, xml_bytes = get_xml_from_pdf(file.read_bytes(), check_xsd=False)
+		# pypdf reads only the parts of the file it needs, so don't load the whole PDF
+		with file.open("rb") as pdf_file:
+			xml_filename, xml_bytes = get_xml_from_pdf(pdf_file, check_xsd=False)
+
 		if not xml_bytes:
 			frappe.throw(
 				msg=_(
@@ -661,27 +754,47 @@ def po_item_query(doctype, txt, searchfield, start, page_len, filters, as_dict=F
 	if not purchase_order:
 		return []
 
-	purchase_order = frappe.get_cached_doc("Purchase Order", purchase_order)
-	purchase_order.check_permission("read")
+	frappe.has_permission("Purchase Order", "read", purchase_order, throw=True)
+
+	item_filters = {"parent": purchase_order, "parenttype": "Purchase Order"}
+	if item_code:
+		item_filters["item_code"] = item_code
+
+	search_filters = None
+	if txt:
+		search_filters = {
+			fieldname: ("like", f"%{txt}%") for fieldname in ("name", "item_code", "item_name", "description")
+		}
+
+	rows = frappe.get_all(
+		"Purchase Order Item",
+		filters=item_filters,
+		or_filters=search_filters,
+		fields=["name", "idx", "item_code", "description", "qty", "uom", "net_rate"],
+		order_by="idx",
+		start=start,
+		page_length=page_len,
+	)
+	if not rows:
+		return []
+
+	meta = frappe.get_meta("Purchase Order Item")
+	currency = frappe.db.get_value("Purchase Order", purchase_order, "currency")
+	qty_field = meta.get_field("qty")
+	rate_field = meta.get_field("net_rate")
 
-	results = [
+	return [
 		[
 			row.name,
 			_("Row {0}").format(row.idx),
 			row.item_code,
 			row.description[:100] + "..." if len(row.description) > 40 else row.description,
-			row.get_formatted("qty") + " " + row.uom,
-			row.get_formatted("net_rate") + " / " + row.uom,
+			frappe.format_value(row.qty, qty_field) + " " + row.uom,
+			frappe.format_value(row.net_rate, rate_field, currency=currency) + " / " + row.uom,
 		]
-		for row in purchase_order.items
-		if not item_code or row.item_code == item_code
+		for row in rows
 	]
 
-	if not txt:
-		return results
-
-	return [row for row in results if txt in ", ".join(row)]
-
 
 @frappe.whitelist()
 def get_po_item_details(po_detail: str):
@@ -1,9 +1,78 @@
 # Copyright (c) 2024, ALYF GmbH and Contributors
 # See license.txt
 
-# import frappe
+from unittest.mock import MagicMock, patch
+
+from frappe.tests import UnitTestCase
 from frappe.tests.utils import FrappeTestCase
 
+from eu_einvoice.european_e_invoice.doctype.e_invoice_import.e_invoice_import import EInvoiceImport
+
+XML_BYTES = b"<rsm:CrossIndustryInvoice/>"
+
+
+def get_import(einvoice_hash=None, is_validated=True) -> MagicMock:
+	"""Return a stand-in for an E Invoice Import whose attachment just changed."""
+	doc = MagicMock(spec=EInvoiceImport)
+	doc.doctype = "E Invoice Import"
+	doc.einvoice = "/private/files/invoice.xml"
+	doc.einvoice_hash = einvoice_hash
+	doc.has_value_changed = MagicMock(return_value=True)
+	doc.get_xml_bytes.return_value = XML_BYTES
+	doc.read_values_from_einvoice.return_value = is_validated
+	return doc
+
+
+class UnitTestEInvoiceImport(UnitTestCase):
+	def test_read_new_einvoice(self):
+		doc = get_import()
+		EInvoiceImport.before_save(doc)
+
+		doc.read_values_from_einvoice.assert_called_once_with(XML_BYTES)
+		doc.guess_supplier.assert_called_once()
+		self.assertTrue(doc.einvoice_hash)
+
+	def test_skip_einvoice_read_before(self):
+		doc = get_import()
+		EInvoiceImport.before_save(doc)
+
+		# the same e-invoice is attached again
+		doc = get_import(einvoice_hash=doc.einvoice_hash)
+		EInvoiceImport.before_save(doc)
+
+		doc.read_values_from_einvoice.assert_not_called()
+		doc.guess_supplier.assert_not_called()
+		doc.guess_po_details.assert_called_once()
+
+	def test_retry_failed_validation(self):
+		doc = get_import(is_validated=False)
+		EInvoiceImport.before_save(doc)
+		self.assertIsNone(doc.einvoice_hash)
+
+		# the same e-invoice is attached again, after the validation failed
+		doc = get_import(einvoice_hash=doc.einvoice_hash)
+		EInvoiceImport.before_save(doc)
+
+		doc.read_values_from_einvoice.assert_called_once_with(XML_BYTES)
+		self.assertTrue(doc.einvoice_hash)
+
+	@patch("eu_einvoice.european_e_invoice.doctype.e_invoice_import.e_invoice_import.frappe")
+	@patch("eu_einvoice.european_e_invoice.doctype.e_invoice_import.e_invoice_import.get_validation_errors")
+	def test_validate_schematron(self, get_validation_errors, frappe):
+		doc = MagicMock(spec=EInvoiceImport)
+		doc.doctype = "E Invoice Import"
+		doc.name = "EIN-00001"
+		doc.profile = "EN 16931"
+
+		get_validation_errors.return_value = (["[BR-01] error"], [])
+		self.assertTrue(EInvoiceImport._validate_schematron(doc, XML_BYTES))
+		self.assertEqual(doc.validation_errors, "[BR-01] error")
+		self.assertEqual(doc.e_invoice_is_correct, 0)
+
+		get_validation_errors.side_effect = RuntimeError("Saxon failed")
+		self.assertFalse(EInvoiceImport._validate_schematron(doc, XML_BYTES))
+		frappe.log_error.assert_called_once()
+
 
 class TestEInvoiceImport(FrappeTestCase):
 	pass
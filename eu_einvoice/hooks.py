@@ -91,6 +91,7 @@ jinja = {
 
 # before_install = "eu_einvoice.install.before_install"
 after_install = "eu_einvoice.install.after_install"
+after_migrate = "eu_einvoice.install.after_migrate"
 
 # Uninstallation
 # ------------
@@ -148,9 +149,27 @@ doc_events = {
 	"Sales Invoice": {
 		"validate": "eu_einvoice.european_e_invoice.custom.sales_invoice.validate_doc",
 		"on_submit": "eu_einvoice.european_e_invoice.custom.sales_invoice.attach_xml_on_submit",
-	}
+	},
+	"Code List": {
+		"on_update": "eu_einvoice.common_codes.clear_cache",
+		"on_trash": "eu_einvoice.common_codes.clear_cache",
+	},
+	"Common Code": {
+		"on_update": "eu_einvoice.common_codes.clear_cache",
+		"on_trash": "eu_einvoice.common_codes.clear_cache",
+	},
+	"Country": {
+		"on_update": "eu_einvoice.countries.clear_cache",
+		"on_trash": "eu_einvoice.countries.clear_cache",
+	},
 }
 
+# Flush cached lookups on `bench clear-cache`, in case records were changed without document events
+clear_cache = [
+	"eu_einvoice.common_codes.clear_cache",
+	"eu_einvoice.countries.clear_cache",
+]
+
 # Scheduled Tasks
 # ---------------
 
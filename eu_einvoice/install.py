@@ -1,7 +1,33 @@
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 
+from .common_codes import clear_cache
 from .custom_fields import get_custom_fields
 
 
 def after_install():
 	create_custom_fields(get_custom_fields())
+	warm_caches()
+
+
+def after_migrate():
+	# The migration may have changed code lists, so resolve the codes from scratch
+	clear_cache()
+	warm_caches()
+
+
+def warm_caches():
+	"""Resolve the default common codes, so the first e-invoice export finds them in the cache."""
+	from eu_einvoice.european_e_invoice.custom.sales_invoice import (
+		duty_tax_fee_category_codes,
+		payment_means_codes,
+		uom_codes,
+		vat_exemption_reason_codes,
+	)
+
+	for retriever in (
+		uom_codes,
+		payment_means_codes,
+		duty_tax_fee_category_codes,
+		vat_exemption_reason_codes,
+	):
+		retriever.get_default_code()
@@ -1,4 +1,5 @@
 import base64
+from functools import lru_cache
 from pathlib import Path
 from typing import Literal
 
@@ -9,8 +10,12 @@ PROFILE_TO_LOGO = {
 }
 
 
+@lru_cache(maxsize=8)
 def get_einvoice_logo(profile: Literal["BASIC", "EN 16931", "EXTENDED"]) -> str | None:
-	"""Return the logo for the given profile, as a base64 encoded data URL."""
+	"""Return the logo for the given profile, as a base64 encoded data URL.
+
+	The logos are static, so each one is read and encoded once per process.
+	"""
 	if profile not in PROFILE_TO_LOGO:
 		return None
 
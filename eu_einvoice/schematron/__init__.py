@@ -1,7 +1,10 @@
+from functools import cache
+from io import BytesIO
 from pathlib import Path
+from threading import RLock
 
-from lxml import objectify
-from saxonche import PySaxonProcessor
+from lxml import etree
+from saxonche import PySaxonProcessor, PyXdmNode, PyXsltExecutable
 
 from eu_einvoice.utils import EInvoiceProfile
 
@@ -12,37 +15,81 @@ PROFILE_TO_XSL = {
 	EInvoiceProfile.XRECHNUNG: "XRechnung-CII-validation.xsl",
 }
 
+SVRL_FAILED_ASSERT = "{http://purl.oclc.org/dsdl/svrl}failed-assert"
+SVRL_SUCCESSFUL_REPORT = "{http://purl.oclc.org/dsdl/svrl}successful-report"
+SVRL_TEXT = "{http://purl.oclc.org/dsdl/svrl}text"
 
-def get_validation_errors(xml_string: str, profile: EInvoiceProfile):
-	return get_errors_from_stylesheet(xml_string, PROFILE_TO_XSL[profile])
+# Saxon processors and executables are not documented as thread-safe. Every use of the
+# shared instances below goes through this lock. saxonche keeps the GIL while it runs,
+# so threads could not validate in parallel anyway.
+_saxon_lock = RLock()
 
 
-def get_errors_from_stylesheet(xml_string: str, stylesheet: str):
+def get_validation_errors(xml: str | PyXdmNode, profile: EInvoiceProfile):
+	"""Validate an XML string, or a document returned by `parse_xml`, against a profile."""
+	return get_errors_from_stylesheet(xml, PROFILE_TO_XSL[profile])
+
+
+def get_errors_from_stylesheet(xml: str | PyXdmNode, stylesheet: str):
 	stylesheet_path = Path(__file__).parent / stylesheet
-	report = get_validation_report(xml_string, str(stylesheet_path))
+	report = get_validation_report(xml, str(stylesheet_path))
 	return extract_failed_asserts(report)
 
 
 def extract_failed_asserts(xml: bytes) -> tuple[list[str], list[str]]:
-	root = objectify.fromstring(xml)
-	failed_asserts = root.xpath(
-		"//svrl:failed-assert/svrl:text",
-		namespaces={"svrl": "http://purl.oclc.org/dsdl/svrl"},
-	)
-	warnings = root.xpath(
-		"//svrl:successful-report/svrl:text",
-		namespaces={"svrl": "http://purl.oclc.org/dsdl/svrl"},
-	)
-	errors = [failed_assert.text.strip() for failed_assert in failed_asserts if failed_assert.text]
-	warnings = [warning.text.strip() for warning in warnings if warning.text]
-	return errors, warnings
+	"""Return the messages of failed asserts (errors) and successful reports (warnings).
 
+	The report is parsed incrementally, and processed elements are discarded right away.
+	"""
+	errors = []
+	warnings = []
+	for _event, element in etree.iterparse(
+		BytesIO(xml), events=("end",), tag=(SVRL_FAILED_ASSERT, SVRL_SUCCESSFUL_REPORT)
+	):
+		messages = errors if element.tag == SVRL_FAILED_ASSERT else warnings
+		messages.extend(text.text.strip() for text in element.iterchildren(SVRL_TEXT) if text.text)
 
-def get_validation_report(xml_string: str, stylesheet_file: str) -> bytes:
-	with PySaxonProcessor(license=False) as proc:
-		xslt30_processor = proc.new_xslt30_processor()
-		input_node = proc.parse_xml(xml_text=xml_string)
-		executable = xslt30_processor.compile_stylesheet(stylesheet_file=stylesheet_file)
-		report = executable.transform_to_string(xdm_node=input_node)
+		element.clear(keep_tail=True)
+		while element.getprevious() is not None:
+			del element.getparent()[0]
+
+	return errors, warnings
 
+
+def get_validation_report(xml: str | PyXdmNode, stylesheet_file: str) -> bytes:
+	with _saxon_lock:
+		input_node = xml if isinstance(xml, PyXdmNode) else parse_xml(xml)
+		report = _get_executable(stylesheet_file).transform_to_string(xdm_node=input_node)
 	return report.encode("utf-8")
+
+
+def parse_xml(xml_string: str) -> PyXdmNode:
+	"""Parse an XML string once, to run several validations on it."""
+	with _saxon_lock:
+		return _get_processor().parse_xml(xml_text=xml_string)
+
+
+def _get_processor() -> PySaxonProcessor:
+	"""Return a long-lived Saxon processor, shared by all validations in this process."""
+	with _saxon_lock:
+		return _create_processor()
+
+
+def _get_executable(stylesheet_file: str) -> PyXsltExecutable:
+	"""Compile a stylesheet once and reuse the executable for every validation.
+
+	Compiling the schematron stylesheets takes much longer than running them. The lock
+	makes sure that concurrent first validations in a threaded worker compile only once.
+	"""
+	with _saxon_lock:
+		return _compile_stylesheet(stylesheet_file)
+
+
+@cache
+def _create_processor() -> PySaxonProcessor:
+	return PySaxonProcessor(license=False)
+
+
+@cache
+def _compile_stylesheet(stylesheet_file: str) -> PyXsltExecutable:
+	return _create_processor().new_xslt30_processor().compile_stylesheet(stylesheet_file=stylesheet_file)
@@ -0,0 +1,26 @@
+from frappe.tests import UnitTestCase
+
+from eu_einvoice.common_codes import _get_docnames_by_code
+
+REC20 = "urn:xoev-de:kosit:codeliste:rec20_3"
+REC21 = "urn:xoev-de:kosit:codeliste:rec21_3"
+
+
+class UnitTestCommonCodes(UnitTestCase):
+	def test_code_differing_in_case(self):
+		# the database matched "h87" against the stored "H87"
+		docnames = _get_docnames_by_code([REC20], ["h87"], [(REC20, "H87", "Nos")])
+		self.assertEqual(docnames, {"h87": "Nos"})
+		self.assertEqual(docnames.get("H87".casefold()), "Nos")
+
+	def test_code_list_precedence(self):
+		rows = [(REC21, "XPK", "Package"), (REC20, "XPK", "Pack")]
+		self.assertEqual(_get_docnames_by_code([REC20, REC21], ["XPK"], rows), {"xpk": "Pack"})
+		self.assertEqual(_get_docnames_by_code([REC21, REC20], ["XPK"], rows), {"xpk": "Package"})
+
+	def test_first_row_wins(self):
+		rows = [(REC20, "C62", "Unit"), (REC20, "C62", "Nos")]
+		self.assertEqual(_get_docnames_by_code([REC20], ["C62"], rows), {"c62": "Unit"})
+
+	def test_unknown_code(self):
+		self.assertEqual(_get_docnames_by_code([REC20], ["XYZ"], [(REC20, "C62", "Nos")]), {})
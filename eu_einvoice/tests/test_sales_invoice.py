@@ -0,0 +1,101 @@
+import os
+from base64 import b64encode
+from tempfile import NamedTemporaryFile
+
+from frappe.tests import UnitTestCase
+
+from eu_einvoice.european_e_invoice.custom.sales_invoice import _is_pdfa3, file_as_base_64
+
+XMP_TEMPLATE = """<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+	<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+		<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/">
+			<dc:format>application/pdf</dc:format>
+		</rdf:Description>
+		{pdfaid}
+	</rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>"""
+PDFAID_NAMESPACE = 'xmlns:pdfaid="http://www.aiim.org/pdfa/ns/id/"'
+
+
+def make_pdf(xmp: str | None = None) -> bytes:
+	"""Return a minimal one-page PDF, with the given XMP metadata stream."""
+	catalog = "<< /Type /Catalog /Pages 2 0 R >>"
+	if xmp is not None:
+		catalog = "<< /Type /Catalog /Pages 2 0 R /Metadata 4 0 R >>"
+
+	objects = [
+		catalog,
+		"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+		"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] >>",
+	]
+	if xmp is not None:
+		objects.append(
+			f"<< /Type /Metadata /Subtype /XML /Length {len(xmp.encode())} >>\nstream\n{xmp}\nendstream"
+		)
+
+	pdf = b"%PDF-1.7\n"
+	offsets = []
+	for number, obj in enumerate(objects, start=1):
+		offsets.append(len(pdf))
+		pdf += f"{number} 0 obj\n{obj}\nendobj\n".encode()
+
+	xref_offset = len(pdf)
+	pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+	pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+	pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode()
+	return pdf
+
+
+class UnitTestFileAsBase64(UnitTestCase):
+	def assert_encodes(self, content: bytes):
+		with NamedTemporaryFile(delete=False) as f:
+			f.write(content)
+
+		try:
+			self.assertEqual(file_as_base_64(f.name), b64encode(content).decode("ascii"))
+		finally:
+			os.remove(f.name)
+
+	def test_empty_file(self):
+		self.assert_encodes(b"")
+
+	def test_small_file(self):
+		self.assert_encodes(b"%PDF-1.7")
+
+	def test_file_of_one_chunk(self):
+		self.assert_encodes(os.urandom(3 * 64 * 1024))
+
+	def test_file_spanning_several_chunks(self):
+		# larger than one 192 KiB chunk, and not a multiple of 3, so the end needs padding
+		content = os.urandom(2 * 3 * 64 * 1024 + 1000)
+		self.assertNotEqual(len(content) % 3, 0)
+		self.assert_encodes(content)
+
+
+class UnitTestIsPDFA3(UnitTestCase):
+	def test_part_as_attribute(self):
+		pdfaid = f'<rdf:Description rdf:about="" {PDFAID_NAMESPACE} pdfaid:part="3" pdfaid:conformance="B"/>'
+		self.assertTrue(_is_pdfa3(make_pdf(XMP_TEMPLATE.format(pdfaid=pdfaid))))
+
+	def test_part_as_element(self):
+		pdfaid = (
+			f'<rdf:Description rdf:about="" {PDFAID_NAMESPACE}>'
+			"<pdfaid:part>3</pdfaid:part><pdfaid:conformance>B</pdfaid:conformance>"
+			"</rdf:Description>"
+		)
+		self.assertTrue(_is_pdfa3(make_pdf(XMP_TEMPLATE.format(pdfaid=pdfaid))))
+
+	def test_other_pdfa_part(self):
+		pdfaid = f'<rdf:Description rdf:about="" {PDFAID_NAMESPACE} pdfaid:part="2" pdfaid:conformance="B"/>'
+		self.assertFalse(_is_pdfa3(make_pdf(XMP_TEMPLATE.format(pdfaid=pdfaid))))
+
+	def test_xmp_without_pdfa(self):
+		self.assertFalse(_is_pdfa3(make_pdf(XMP_TEMPLATE.format(pdfaid=""))))
+
+	def test_pdf_without_xmp(self):
+		self.assertFalse(_is_pdfa3(make_pdf()))
+
+	def test_invalid_pdf(self):
+		self.assertFalse(_is_pdfa3(b"This is not a PDF"))
@@ -0,0 +1,44 @@
+from frappe.tests import UnitTestCase
+
+from eu_einvoice.schematron import extract_failed_asserts
+
+SVRL_REPORT = """<?xml version="1.0" encoding="UTF-8"?>
+<svrl:schematron-output xmlns:svrl="http://purl.oclc.org/dsdl/svrl">
+	<svrl:active-pattern document="invoice.xml"/>
+	<svrl:fired-rule context="/rsm:CrossIndustryInvoice"/>
+	<svrl:failed-assert id="BR-01" location="/rsm:CrossIndustryInvoice" test="exists(...)">
+		<svrl:text>
+			[BR-01]-An Invoice shall have a Specification identifier (BT-24).
+		</svrl:text>
+	</svrl:failed-assert>
+	<svrl:successful-report id="BR-DE-21" location="/rsm:CrossIndustryInvoice" test="true()">
+		<svrl:text>[BR-DE-21] The Specification identifier should match XRechnung.</svrl:text>
+	</svrl:successful-report>
+	<svrl:failed-assert id="BR-CO-10" location="/rsm:CrossIndustryInvoice" test="sum(...)">
+		<svrl:diagnostic-reference diagnostic="BR-CO-10">not a message</svrl:diagnostic-reference>
+		<svrl:text>[BR-CO-10]-Sum of Invoice line net amount (BT-106) = Σ Invoice line net amount (BT-131).</svrl:text>
+	</svrl:failed-assert>
+	<svrl:failed-assert id="empty" location="/" test="false()">
+		<svrl:text>   </svrl:text>
+	</svrl:failed-assert>
+	<text>Not in the SVRL namespace</text>
+</svrl:schematron-output>
+""".encode()
+
+
+class UnitTestSchematron(UnitTestCase):
+	def test_extract_failed_asserts(self):
+		errors, warnings = extract_failed_asserts(SVRL_REPORT)
+		self.assertEqual(
+			errors,
+			[
+				"[BR-01]-An Invoice shall have a Specification identifier (BT-24).",
+				"[BR-CO-10]-Sum of Invoice line net amount (BT-106) = Σ Invoice line net amount (BT-131).",
+				"",
+			],
+		)
+		self.assertEqual(warnings, ["[BR-DE-21] The Specification identifier should match XRechnung."])
+
+	def test_extract_from_valid_report(self):
+		report = b'<svrl:schematron-output xmlns:svrl="http://purl.oclc.org/dsdl/svrl"/>'
+		self.assertEqual(extract_failed_asserts(report), ([], []))
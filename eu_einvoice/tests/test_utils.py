@@ -0,0 +1,36 @@
+from frappe.tests import UnitTestCase
+
+from eu_einvoice.utils import EInvoiceProfile
+
+
+class UnitTestEInvoiceProfile(UnitTestCase):
+	def test_ordering(self):
+		self.assertEqual(
+			sorted(EInvoiceProfile),
+			[
+				EInvoiceProfile.BASIC,
+				EInvoiceProfile.EN16931,
+				EInvoiceProfile.XRECHNUNG,
+				EInvoiceProfile.EXTENDED,
+			],
+		)
+		self.assertTrue(EInvoiceProfile.XRECHNUNG < EInvoiceProfile.EXTENDED)
+		self.assertTrue(EInvoiceProfile.EN16931 <= EInvoiceProfile.EN16931)
+		self.assertFalse(EInvoiceProfile.BASIC > EInvoiceProfile.EN16931)
+		self.assertFalse(EInvoiceProfile.BASIC >= EInvoiceProfile.XRECHNUNG)
+
+	def test_compare_with_string(self):
+		# Plain strings are ranked like the profile they stand for, not alphabetically
+		self.assertFalse(EInvoiceProfile.EXTENDED < "XRECHNUNG")
+		self.assertFalse(EInvoiceProfile.XRECHNUNG >= "EXTENDED")
+		self.assertTrue(EInvoiceProfile.EXTENDED > "XRECHNUNG")
+		self.assertTrue(EInvoiceProfile.EN16931 <= "EN 16931")
+		self.assertTrue("XRECHNUNG" < EInvoiceProfile.EXTENDED)
+		self.assertTrue("EXTENDED" >= EInvoiceProfile.XRECHNUNG)
+
+	def test_compare_with_invalid_value(self):
+		with self.assertRaises(ValueError):
+			EInvoiceProfile.BASIC < "MINIMUM"  # noqa: B015
+
+		with self.assertRaises(TypeError):
+			EInvoiceProfile.BASIC < 1  # noqa: B015
@@ -1,9 +1,7 @@
-from enum import Enum
-from functools import total_ordering
+from enum import StrEnum
 
 
-@total_ordering
-class EInvoiceProfile(Enum):
+class EInvoiceProfile(StrEnum):
 	"""
 	Profiles according to Factur-X Specification 1.07.2 page 18.
 	'MINIMUM' and 'BASIC WL' are not included because they are not valid tax invoices.
@@ -15,47 +13,85 @@ class EInvoiceProfile(Enum):
 	XRECHNUNG = "XRECHNUNG"
 
 	def __lt__(self, other):
-		# https://stackoverflow.com/a/39269589
-		order = [
-			EInvoiceProfile.BASIC,
-			EInvoiceProfile.EN16931,
-			EInvoiceProfile.XRECHNUNG,
-			EInvoiceProfile.EXTENDED,
-		]
-		return order.index(self) < order.index(other)
-
-
-# Map of EInvoiceProfile to drafthorse schema name
-PROFILE_TO_SCHEMA = {
-	EInvoiceProfile.BASIC: "FACTUR-X_BASIC",
-	EInvoiceProfile.EN16931: "FACTUR-X_EN16931",
-	EInvoiceProfile.XRECHNUNG: "FACTUR-X_EN16931",
-	EInvoiceProfile.EXTENDED: "FACTUR-X_EXTENDED",
-}
+		other_rank = _get_rank(other)
+		if other_rank is None:
+			return NotImplemented
+		return _PROFILE_RANK[self] < other_rank
+
+	def __le__(self, other):
+		other_rank = _get_rank(other)
+		if other_rank is None:
+			return NotImplemented
+		return _PROFILE_RANK[self] <= other_rank
+
+	def __gt__(self, other):
+		other_rank = _get_rank(other)
+		if other_rank is None:
+			return NotImplemented
+		return _PROFILE_RANK[self] > other_rank
+
+	def __ge__(self, other):
+		other_rank = _get_rank(other)
+		if other_rank is None:
+			return NotImplemented
+		return _PROFILE_RANK[self] >= other_rank
 
-# Map of EInvoiceProfile to GuidelineSpecifiedDocumentContextParameter
-PROFILE_TO_GUIDELINE = {
-	EInvoiceProfile.BASIC: "urn:cen.eu:en16931:2017#compliant#urn:factur-x.eu:1p0:basic",
-	EInvoiceProfile.EN16931: "urn:cen.eu:en16931:2017",
-	EInvoiceProfile.XRECHNUNG: "urn:cen.eu:en16931:2017#compliant#urn:xeinkauf.de:kosit:xrechnung_3.0",
-	EInvoiceProfile.EXTENDED: "urn:cen.eu:en16931:2017#conformant#urn:factur-x.eu:1p0:extended",
+
+def _get_rank(other) -> int | None:
+	"""Return the rank of a profile or profile value, None if `other` is no profile at all.
+
+	Plain strings are converted to a profile, so they are never compared alphabetically
+	(which `str` would do as a fallback). Unknown values raise a ValueError.
+	"""
+	if other.__class__ is not EInvoiceProfile:
+		if not isinstance(other, str):
+			return None
+		other = EInvoiceProfile(other)
+
+	return _PROFILE_RANK[other]
+
+
+# Order of the profiles from least to most detailed
+_PROFILE_RANK: dict[EInvoiceProfile, int] = {
+	EInvoiceProfile.BASIC: 0,
+	EInvoiceProfile.EN16931: 1,
+	EInvoiceProfile.XRECHNUNG: 2,
+	EInvoiceProfile.EXTENDED: 3,
 }
-GUIDELINE_TO_PROFILE = {v: k for k, v in PROFILE_TO_GUIDELINE.items()}
 
 
-def get_drafthorse_schema(profile: EInvoiceProfile) -> str:
-	"""Return the drafthorse schema name for the given profile."""
-	return PROFILE_TO_SCHEMA.get(profile)
+# Map of EInvoiceProfile to drafthorse schema name and GuidelineSpecifiedDocumentContextParameter
+PROFILE_META: dict[EInvoiceProfile, tuple[str, str]] = {
+	EInvoiceProfile.BASIC: (
+		"FACTUR-X_BASIC",
+		"urn:cen.eu:en16931:2017#compliant#urn:factur-x.eu:1p0:basic",
+	),
+	EInvoiceProfile.EN16931: (
+		"FACTUR-X_EN16931",
+		"urn:cen.eu:en16931:2017",
+	),
+	EInvoiceProfile.XRECHNUNG: (
+		"FACTUR-X_EN16931",
+		"urn:cen.eu:en16931:2017#compliant#urn:xeinkauf.de:kosit:xrechnung_3.0",
+	),
+	EInvoiceProfile.EXTENDED: (
+		"FACTUR-X_EXTENDED",
+		"urn:cen.eu:en16931:2017#conformant#urn:factur-x.eu:1p0:extended",
+	),
+}
+PROFILE_TO_SCHEMA = {profile: schema for profile, (schema, _) in PROFILE_META.items()}
+PROFILE_TO_GUIDELINE = {profile: guideline for profile, (_, guideline) in PROFILE_META.items()}
+GUIDELINE_TO_PROFILE = {v: k for k, v in PROFILE_TO_GUIDELINE.items()}
 
 
-def get_guideline(profile: EInvoiceProfile) -> str:
-	"""Return the guideline for the given profile."""
-	return PROFILE_TO_GUIDELINE.get(profile)
+# Return the drafthorse schema name for the given profile.
+get_drafthorse_schema = PROFILE_TO_SCHEMA.get
 
+# Return the guideline for the given profile.
+get_guideline = PROFILE_TO_GUIDELINE.get
 
-def get_profile(guideline: str) -> EInvoiceProfile:
-	"""Return the profile for the given guideline."""
-	return GUIDELINE_TO_PROFILE.get(guideline)
+# Return the profile for the given guideline.
+get_profile = GUIDELINE_TO_PROFILE.get
 
 
 def identity(value):